@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
+import itertools
 import json
 import os
 import re
 import socket
 import subprocess
 import threading
+import time
 import uuid
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
-from functools import wraps
+from functools import lru_cache, wraps
 from pathlib import Path
 
-from flask import Flask, jsonify, render_template, request
+import orjson
+from flask import Flask, Response, jsonify, render_template, request
 
 app = Flask(__name__)
 
@@ -20,11 +24,40 @@ PATCH_BASE_DIR = Path(os.getenv("PATCH_BASE_DIR", "/opt/patch-system"))
 META_FILE = PATCH_BASE_DIR / ".deploy_meta.json"
 PATCH_PORT = int(os.getenv("PATCH_PORT", "3000"))
 MAX_LOG_LINES = int(os.getenv("MAX_LOG_LINES", "5000"))
+MAX_JOBS = int(os.getenv("MAX_JOBS", "256"))
+PORT_CHECK_TTL = 1.0
+DEFAULT_REPO = os.getenv("DEFAULT_REPO", "").strip()
 
-jobs = {}
+
+def parse_allowed_ips() -> frozenset:
+    raw = os.getenv("OPS_ALLOWED_IPS", "").strip()
+    if not raw:
+        return frozenset()
+    return frozenset(ip.strip() for ip in raw.split(",") if ip.strip())
+
+
+# Access settings come from the service environment and only change on
+# restart, so they are resolved once instead of on every request.
+_ALLOWED_IPS = parse_allowed_ips()
+_IP_FILTER_ENABLED = bool(_ALLOWED_IPS)
+_EXPECTED_USER = os.getenv("OPS_USERNAME", "")
+_EXPECTED_PASS = os.getenv("OPS_PASSWORD", "")
+_AUTH_ENABLED = bool(_EXPECTED_USER or _EXPECTED_PASS)
+
+_REPO_RE = re.compile(r"^(https://|git@)[A-Za-z0-9._:/-]+(\.git)?$")
+_REF_RE = re.compile(r"^[A-Za-z0-9._/\-]{1,128}$")
+_NEWLINE_RE = re.compile(rb"\r\n?|\n")
+
+# jobs_lock guards adding/evicting ``jobs`` entries and ``running_job_id``;
+# each job's mutable fields are guarded by its own ``lock``, always taken
+# after jobs_lock when both are needed.
+jobs = OrderedDict()
 jobs_lock = threading.Lock()
 running_job_id = None
 
+_port_cache = {"ts": float("-inf"), "value": False}
+_port_cache_lock = threading.Lock()
+
 
 def now_iso() -> str:
     return datetime.now(tz=timezone.utc).isoformat()
@@ -36,55 +69,65 @@ def is_port_open(host: str, port: int, timeout: float = 0.5) -> bool:
         return sock.connect_ex((host, port)) == 0
 
 
+def patch_port_open() -> bool:
+    # Shared by every status poller; probe at most once per PORT_CHECK_TTL.
+    with _port_cache_lock:
+        now = time.monotonic()
+        if now - _port_cache["ts"] >= PORT_CHECK_TTL:
+            _port_cache["value"] = is_port_open("127.0.0.1", PATCH_PORT)
+            _port_cache["ts"] = now
+        return _port_cache["value"]
+
+
 def validate_repo(repo: str) -> bool:
-    pattern = r"^(https://|git@)[A-Za-z0-9._:/-]+(\.git)?$"
-    return bool(re.match(pattern, repo))
+    return _REPO_RE.match(repo) is not None
 
 
 def validate_ref(ref: str) -> bool:
-    return bool(re.match(r"^[A-Za-z0-9._/\-]{1,128}$", ref))
+    return _REF_RE.match(ref) is not None
+
+
+@lru_cache(maxsize=1)
+def _parse_meta(mtime_ns: int) -> dict:
+    # mtime_ns is only the cache key; the file is re-read when it changes.
+    # Read/parse errors propagate so a half-written file is never cached.
+    content = json.loads(META_FILE.read_text(encoding="utf-8"))
+    return {
+        "commit": content.get("deployed_commit", "unknown"),
+        "ref": content.get("deployed_ref", "unknown"),
+        "updated_at": content.get("updated_at"),
+    }
 
 
 def get_current_version() -> dict:
-    if META_FILE.exists():
-        try:
-            content = json.loads(META_FILE.read_text(encoding="utf-8"))
-            return {
-                "commit": content.get("deployed_commit", "unknown"),
-                "ref": content.get("deployed_ref", "unknown"),
-                "updated_at": content.get("updated_at"),
-            }
-        except json.JSONDecodeError:
-            return {"commit": "unknown", "ref": "unknown", "updated_at": None}
-    return {"commit": "unknown", "ref": "unknown", "updated_at": None}
-
-
-def parse_allowed_ips() -> set:
-    raw = os.getenv("OPS_ALLOWED_IPS", "").strip()
-    if not raw:
-        return set()
-    return {ip.strip() for ip in raw.split(",") if ip.strip()}
+    try:
+        mtime_ns = os.stat(META_FILE).st_mtime_ns
+    except OSError:
+        return {"commit": "unknown", "ref": "unknown", "updated_at": None}
+    try:
+        return dict(_parse_meta(mtime_ns))
+    except (OSError, json.JSONDecodeError):
+        return {"commit": "unknown", "ref": "unknown", "updated_at": None}
 
 
 def request_auth_ok() -> bool:
-    expected_user = os.getenv("OPS_USERNAME", "")
-    expected_pass = os.getenv("OPS_PASSWORD", "")
-    if not expected_user and not expected_pass:
+    if not _AUTH_ENABLED:
         return True
 
     auth = request.authorization
     if not auth:
         return False
-    return auth.username == expected_user and auth.password == expected_pass
+    return auth.username == _EXPECTED_USER and auth.password == _EXPECTED_PASS
 
 
 def request_ip_ok() -> bool:
-    allowed_ips = parse_allowed_ips()
-    if not allowed_ips:
+    if not _IP_FILTER_ENABLED:
         return True
-    client_ip = request.headers.get("X-Forwarded-For", request.remote_addr or "")
-    client_ip = client_ip.split(",")[0].strip()
-    return client_ip in allowed_ips
+    raw = request.headers.get("X-Forwarded-For") or request.remote_addr or ""
+    # Only the first (client) hop matters; avoid building a list for it.
+    idx = raw.find(",")
+    client_ip = (raw[:idx] if idx >= 0 else raw).strip()
+    return client_ip in _ALLOWED_IPS
 
 
 def require_guard(fn):
@@ -104,18 +147,53 @@ def require_guard(fn):
 
 
 def append_log(job_id: str, line: str) -> None:
-    with jobs_lock:
-        job = jobs.get(job_id)
-        if not job:
-            return
-        job["logs"].append(line.rstrip("\n"))
-        if len(job["logs"]) > MAX_LOG_LINES:
-            job["logs"] = job["logs"][-MAX_LOG_LINES:]
+    # Called once per output line; only the job's own lock is taken so
+    # status polling never waits behind a chatty subprocess.
+    job = jobs.get(job_id)
+    if not job:
+        return
+    with job["lock"]:
+        logs = job["logs"]
+        if len(logs) == logs.maxlen:
+            job["log_start_index"] += 1
+        logs.append(line.rstrip("\n"))
+
+
+def stream_output(job_id: str, fd: int) -> None:
+    # Drain the pipe in large raw reads and split lines ourselves, treating
+    # \r\n, \r and \n as line breaks like text mode does. Only new bytes are
+    # scanned; a partial line is carried over to the next chunk, and a chunk
+    # ending in \r remembers to drop a \n that starts the next one.
+    pending = bytearray()
+    skip_lf = False
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        start = 1 if skip_lf and chunk.startswith(b"\n") else 0
+        for match in _NEWLINE_RE.finditer(chunk, start):
+            pending += chunk[start : match.start()]
+            append_log(job_id, pending.decode("utf-8", "replace"))
+            pending.clear()
+            start = match.end()
+        pending += chunk[start:]
+        skip_lf = chunk.endswith(b"\r")
+    if pending:
+        append_log(job_id, pending.decode("utf-8", "replace"))
+
+
+def finish_job(job_id: str, status: str, return_code: int) -> None:
+    job = jobs.get(job_id)
+    if not job:
+        return
+    with job["lock"]:
+        job["status"] = status
+        job["finished_at"] = now_iso()
+        job["return_code"] = return_code
 
 
 def run_job(job_id: str, action: str, repo: str = "", ref: str = "main") -> None:
     global running_job_id
-    env = os.environ.copy()
     cmd = [str(SCRIPT_PATH), action]
     if action in {"download", "deploy", "upgrade"}:
         cmd.extend([repo, ref])
@@ -125,28 +203,17 @@ def run_job(job_id: str, action: str, repo: str = "", ref: str = "main") -> None
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            env=env,
+            bufsize=0,
         )
-        for line in process.stdout or []:
-            append_log(job_id, line)
+        stream_output(job_id, process.stdout.fileno())
         return_code = process.wait()
-        with jobs_lock:
-            job = jobs.get(job_id, {})
-            job["status"] = "success" if return_code == 0 else "failed"
-            job["finished_at"] = now_iso()
-            job["return_code"] = return_code
-            jobs[job_id] = job
+        finish_job(job_id, "success" if return_code == 0 else "failed", return_code)
     except Exception as exc:  # noqa: BLE001
         append_log(job_id, f"[ERROR] Unexpected exception: {exc}")
-        with jobs_lock:
-            job = jobs.get(job_id, {})
-            job["status"] = "failed"
-            job["finished_at"] = now_iso()
-            job["return_code"] = -1
-            jobs[job_id] = job
+        finish_job(job_id, "failed", -1)
     finally:
+        # Every action can rewrite the deploy meta file.
+        _parse_meta.cache_clear()
         with jobs_lock:
             if running_job_id == job_id:
                 running_job_id = None
@@ -155,22 +222,36 @@ def run_job(job_id: str, action: str, repo: str = "", ref: str = "main") -> None
 def create_job(action: str, repo: str = "", ref: str = "main"):
     global running_job_id
     with jobs_lock:
-        if running_job_id and jobs.get(running_job_id, {}).get("status") == "running":
-            return None, running_job_id
+        running = jobs.get(running_job_id) if running_job_id else None
+        if running:
+            with running["lock"]:
+                if running["status"] == "running":
+                    return None, running_job_id
 
         job_id = str(uuid.uuid4())
+        # One clock read for both the log preface (local time, same format as
+        # ops_task.sh) and started_at.
+        created = time.time()
         jobs[job_id] = {
             "id": job_id,
             "action": action,
             "repo": repo,
             "ref": ref,
             "status": "running",
-            "logs": [f"[{datetime.now().strftime('%F %T')}] Job created: {action}"],
-            "started_at": now_iso(),
+            "logs": deque(
+                [f"[{time.strftime('%F %T', time.localtime(created))}] Job created: {action}"],
+                maxlen=MAX_LOG_LINES,
+            ),
+            "log_start_index": 0,
+            "lock": threading.Lock(),
+            "started_at": datetime.fromtimestamp(created, tz=timezone.utc).isoformat(),
             "finished_at": None,
             "return_code": None,
         }
         running_job_id = job_id
+        # Drop the oldest finished jobs so history stays bounded.
+        while len(jobs) > MAX_JOBS and next(iter(jobs)) != running_job_id:
+            jobs.popitem(last=False)
 
     thread = threading.Thread(target=run_job, args=(job_id, action, repo, ref), daemon=True)
     thread.start()
@@ -187,16 +268,17 @@ def index():
 @require_guard
 def api_status():
     version = get_current_version()
-    with jobs_lock:
-        active_job = running_job_id
+    # A single global read is atomic; writers still hold jobs_lock so the id
+    # stays ordered with the job's status transitions.
+    active_job = running_job_id
     return jsonify(
         {
-            "patch_running": is_port_open("127.0.0.1", PATCH_PORT),
+            "patch_running": patch_port_open(),
             "patch_port": PATCH_PORT,
             "version": version,
             "active_job": active_job,
-            "auth_enabled": bool(os.getenv("OPS_USERNAME", "") or os.getenv("OPS_PASSWORD", "")),
-            "ip_filter_enabled": bool(parse_allowed_ips()),
+            "auth_enabled": _AUTH_ENABLED,
+            "ip_filter_enabled": _IP_FILTER_ENABLED,
         }
     )
 
@@ -210,23 +292,27 @@ def api_job(job_id: str):
         offset = 0
     offset = max(offset, 0)
 
-    with jobs_lock:
-        job = jobs.get(job_id)
-        if not job:
-            return jsonify({"error": "job_not_found"}), 404
-        logs = job["logs"][offset:]
-        return jsonify(
-            {
-                "id": job["id"],
-                "action": job["action"],
-                "status": job["status"],
-                "started_at": job["started_at"],
-                "finished_at": job["finished_at"],
-                "return_code": job["return_code"],
-                "logs": logs,
-                "next_offset": offset + len(logs),
-            }
-        )
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "job_not_found"}), 404
+    with job["lock"]:
+        # offset counts lines since the job started; lines before
+        # log_start_index have already rolled out of the deque.
+        log_start_index = job["log_start_index"]
+        start = max(offset - log_start_index, 0)
+        logs = list(itertools.islice(job["logs"], start, None))
+        next_offset = log_start_index + len(job["logs"])
+        payload = {
+            "id": job["id"],
+            "action": job["action"],
+            "status": job["status"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "return_code": job["return_code"],
+            "logs": logs,
+            "next_offset": next_offset,
+        }
+    return Response(orjson.dumps(payload), mimetype="application/json")
 
 
 def parse_repo_ref():
@@ -234,8 +320,7 @@ def parse_repo_ref():
     repo = (data.get("repo") or "").strip()
     ref = (data.get("ref") or "main").strip() or "main"
     if not repo:
-        default_repo = os.getenv("DEFAULT_REPO", "").strip()
-        repo = default_repo
+        repo = DEFAULT_REPO
     return repo, ref
 
 
@@ -288,4 +373,11 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "4000"))
     debug = os.getenv("FLASK_DEBUG", "0") == "1"
-    app.run(host=host, port=port, debug=debug, threaded=True)
+    if debug:
+        app.run(host=host, port=port, debug=True, threaded=True)
+    else:
+        # Job state lives in this process, so serve from one process with a
+        # bounded thread pool rather than a thread per connection.
+        from waitress import serve
+
+        serve(app, host=host, port=port, threads=int(os.getenv("THREADS", "8")))